@@ -52,7 +52,7 @@ class ArmyLeader(Enum):
 
 
 BIN_SIZE_DAMAGE_STRATEGY = len(bin(DamageStrategy.KNIGHTS_FIRST.value)) - 2
-BIN_SIZE_ARMY_LEADER = len(bin(ArmyLeader.LORD_OR_TITLED_LADY.value)) - 2
+BIN_SIZE_ARMY_LEADER = len(bin(ArmyLeader.DARC.value)) - 2
 BIN_SIZE_DEFENSIVE_STRUCTURE = len(bin(DefensiveStructure.FORTIFIED_CITY.value)) - 2
 
 
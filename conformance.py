@@ -0,0 +1,361 @@
+import copy
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import time
+
+import battlesimulation
+import fief_army_simulation as fief
+
+JS_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "docs", "battle-simulator.js")
+
+GRID_ATTACKERS = [(3, 0), (6, 1), (10, 3), (13, 8)]
+GRID_DEFENDERS = [(2, 0), (5, 2), (9, 4)]
+
+# plain matchups without structures, where both cache stores must reproduce the exact odds
+CACHE_CHECKS = [((6, 0, 0, 0), (5, 0, 0, 0)), ((4, 1, 0, 0), (3, 1, 0, 0)), ((9, 2, 0, 1), (7, 2, 0, 0))]
+
+# armies travel between engines as plain (men_at_arms, knights, structure, leader) tuples
+def grid():
+    cells = []
+    for leader in (fief.ArmyLeader.NONE_OR_LADY, fief.ArmyLeader.DARC):
+        for maa, kn in GRID_ATTACKERS:
+            for structure in fief.DefensiveStructure:
+                for b_maa, b_kn in GRID_DEFENDERS:
+                    cells.append(((maa, kn, 0, leader.value), (b_maa, b_kn, structure.value, 0)))
+    return cells
+
+def army(module, a):
+    maa, kn, structure, leader = a
+    return module.Army(maa, kn, module.DefensiveStructure(structure), module.ArmyLeader(leader))
+
+
+# ============================================================
+# Deterministic pieces
+# ============================================================
+
+def damage_cases():
+    return [((maa, kn, 0, 0), damage, strategy.value)
+            for maa in range(fief.MAX_MEN_AT_ARMS + 1)
+            for kn in range(fief.MAX_KNIGHTS + 1)
+            for damage in range(4 * max(fief.DICE_SETS) + 1)
+            for strategy in fief.DamageStrategy]
+
+def dice_cases():
+    return [((maa, kn, structure.value, leader.value), penalty)
+            for maa in range(fief.MAX_MEN_AT_ARMS + 1)
+            for kn in range(fief.MAX_KNIGHTS + 1)
+            for structure in fief.DefensiveStructure
+            for leader in fief.ArmyLeader
+            for penalty in range(-2, 1)]
+
+def python_pieces(module):
+    damage = []
+    for a, d, strategy in damage_cases():
+        x = army(module, a)
+        try:
+            r = x.apply_damage(d, module.DamageStrategy(strategy))
+            damage.append([r, x.knights, x.men_at_arms])
+        except Exception:
+            damage.append("error")
+    dice = []
+    for a, penalty in dice_cases():
+        x = army(module, a)
+        dice.append([x.dice(penalty), x.strength_points(), x.army_points(), x.attacker_penalty()])
+    return {"apply_damage": damage, "dice": dice}
+
+
+# ============================================================
+# Engines
+# ============================================================
+
+def exact_engine(cells, iterations):
+    cache = fief.ExactBattleCache()
+    results = []
+    for a, b in cells:
+        w, t, l, s = cache.outcome(fief.Battle(army(fief, a), army(fief, b)))
+        results.append((w, t, l, math.inf))
+    return results
+
+def battle_engine(cells, iterations):
+    results = []
+    for a, b in cells:
+        rule = fief.BattleStopRule.ANNIHILATION
+        w, t, l, r = fief.battle_outcomes(army(fief, a), army(fief, b), [rule], iterations)[rule]
+        results.append((w, t, l, iterations))
+    return results
+
+def iterator_engine(cells, iterations):
+    results = []
+    for a, b in cells:
+        counts = {1: 0, 0: 0, -1: 0}
+        battle = fief.Battle(army(fief, a), army(fief, b))
+        for i in range(iterations):
+            status, res, indicator = copy.deepcopy(battle).resolve()
+            counts[indicator] += 1
+        results.append((counts[1] / iterations, counts[0] / iterations, counts[-1] / iterations, iterations))
+    return results
+
+def cache_engine(cells, iterations):
+    cache = fief.BattleCache()
+    results = []
+    for a, b in cells:
+        battle = fief.Battle(army(fief, a), army(fief, b))
+        for i in range(iterations):
+            cache.resolve(battle)
+        w, l, t, s = cache.probability(battle)
+        results.append((w, t, l, s))
+    return results
+
+def battlesimulation_engine(cells, iterations):
+    # battlesimulation.py only ports the army and dice rules, driven here by the battle() loop
+    bs = battlesimulation
+    results = []
+    for a, b in cells:
+        a, b = army(bs, a), army(bs, b)
+        penaltyA = b.attacker_penalty()
+        penaltyB = a.attacker_penalty()
+        counts = {1: 0, 0: 0, -1: 0}
+        for i in range(iterations):
+            ai = copy.copy(a)
+            bi = copy.copy(b)
+            while True:
+                dcA = ai.dice(penaltyA)
+                dcB = bi.dice(penaltyB)
+                if dcA == 0 or dcB == 0:
+                    lostA, lostB = dcA == 0, dcB == 0
+                    break
+                dA = bs.DICE_SETS[dcA].roll()
+                dB = bs.DICE_SETS[dcB].roll()
+                ai.apply_damage(dB, bs.DamageStrategy.MEN_AT_ARMS_FIRST)
+                bi.apply_damage(dA, bs.DamageStrategy.MEN_AT_ARMS_FIRST)
+                if ai.is_defeated() or bi.is_defeated():
+                    lostA, lostB = ai.is_defeated(), bi.is_defeated()
+                    break
+            counts[lostB - lostA] += 1
+        results.append((counts[1] / iterations, counts[0] / iterations, counts[-1] / iterations, iterations))
+    return results
+
+JS_DRIVER = """
+const input = JSON.parse(require("fs").readFileSync(0, "utf8"));
+const army = ([m, k, s, l]) => new Army(m, k, s, l);
+const output = {};
+output.apply_damage = input.damage.map(([a, d, strategy]) => {
+  const x = army(a);
+  const r = x.applyDamage(d, strategy);
+  return [r, x.knights, x.menAtArms];
+});
+output.dice = input.dice.map(([a, penalty]) => {
+  const x = army(a);
+  return [x.dice(penalty), x.strengthPoints(), x.armyPoints(), x.attackerPenalty()];
+});
+const start = Date.now();
+output.battles = input.cells.map(([a, b]) => {
+  const r = battle(army(a), army(b), input.iterations);
+  return [r.winA, r.ties, r.winB];
+});
+output.seconds = (Date.now() - start) / 1000;
+console.log(JSON.stringify(output));
+"""
+
+def run_javascript(cells, iterations):
+    # the simulator page minus its React component, fed through node
+    with open(JS_ENGINE, 'r', encoding='utf8') as f:
+        source = f.read()
+    source = source[:source.index("// Lucide icons")].replace("const { useState } = React;", "")
+    payload = json.dumps({"cells": cells, "iterations": iterations, "damage": damage_cases(), "dice": dice_cases()})
+    completed = subprocess.run(["node", "-e", source + JS_DRIVER], input=payload, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout)
+
+# name -> (kind, engine); javascript is added when node is installed
+ENGINES = {
+    "exact": ("exact", exact_engine),
+    "battle": ("sampled", battle_engine),
+    "iterator": ("sampled", iterator_engine),
+    "cache": ("sampled", cache_engine),
+    "battlesimulation": ("sampled", battlesimulation_engine),
+}
+
+# a round settles as (attacker, defender, damage left over after hitting the attacker, after hitting the defender)
+# -> indicator, or None while the battle goes on
+def settle_reference(an, bn, a_left, b_left):
+    if an.is_defeated() or bn.is_defeated():
+        return bn.is_defeated() - an.is_defeated()
+    return None
+
+def settle_cache(an, bn, a_left, b_left):
+    # dice are checked before defeat, so an attacker left with zero dice against an annihilated defender ties
+    status, res, indicator = fief.Battle(an, bn).battle_status()
+    return indicator if status == "resolved" else None
+
+def settle_javascript(an, bn, a_left, b_left):
+    # the side whose damage was left over wins a mutual annihilation
+    if an.is_defeated() and bn.is_defeated() and a_left != b_left:
+        return -1 if a_left else 1
+    return settle_reference(an, bn, a_left, b_left)
+
+# divergences that pre-date the harness: a failing cell is only excused when the engine
+# matches the exact odds under the settle rule below, any other failing cell fails the run
+KNOWN_DIVERGENCES = {
+    "cache": ("battle_status() calls a battle a tie when the attacker survives a round with zero dice and the defender is annihilated; the iterator calls it a win", settle_cache),
+    "javascript": ("a mutual annihilation is decided by which side had damage left over instead of being a tie", settle_javascript),
+}
+
+def settled_odds(a, b, settle):
+    # exact (win, tie, loss) of a plain battle whose rounds settle by the given rule
+    a, b = army(fief, a), army(fief, b)
+    penaltyA, penaltyB = b.attacker_penalty(), a.attacker_penalty()
+    damaged, db = {}, {}
+
+    def hits(x, dice):
+        key = x.men_at_arms, x.knights, x.structure, x.leader, dice
+        if key not in damaged:
+            armies = {}
+            for damage, p in fief.DICE_SETS[dice].distribution().items():
+                y = copy.copy(x)
+                left = y.apply_damage(damage) > 0
+                k = y.men_at_arms, y.knights, left
+                armies[k] = y, left, armies[k][2] + p if k in armies else p
+            damaged[key] = list(armies.values())
+        return damaged[key]
+
+    def solve(ai, bi):
+        key = ai.men_at_arms, ai.knights, bi.men_at_arms, bi.knights
+        if key in db:
+            return db[key]
+        dcA, dcB = ai.dice(penaltyA), bi.dice(penaltyB)
+        if dcA == 0 or dcB == 0:
+            return float(dcB == 0 and dcA > 0), float(dcA == dcB), float(dcA == 0 and dcB > 0)
+        w, t, l, stay = 0.0, 0.0, 0.0, 0.0
+        for an, a_left, pa in hits(ai, dcB):
+            for bn, b_left, pb in hits(bi, dcA):
+                p = pa * pb
+                indicator = settle(an, bn, a_left, b_left)
+                if indicator is not None:
+                    w, t, l = w + p * (indicator == 1), t + p * (indicator == 0), l + p * (indicator == -1)
+                elif an == ai and bn == bi:
+                    stay += p
+                else:
+                    nw, nt, nl = solve(an, bn)
+                    w, t, l = w + p * nw, t + p * nt, l + p * nl
+        db[key] = w / (1 - stay), t / (1 - stay), l / (1 - stay)
+        return db[key]
+
+    return solve(a, b) + (math.inf,)
+
+def available_engines():
+    engines = dict(ENGINES)
+    if shutil.which("node") and os.path.exists(JS_ENGINE):
+        engines["javascript"] = ("sampled", None)
+    return engines
+
+
+# ============================================================
+# Comparison
+# ============================================================
+
+def cache_checks(limit):
+    failures = []
+    for store in (fief.BattleCache, fief.ArrayBattleCache):
+        cache = store()
+        for a, b in CACHE_CHECKS:
+            battle = fief.Battle(army(fief, a), army(fief, b))
+            for i in range(1000):
+                cache.resolve(battle)
+            w, l, t, s = cache.probability(battle)
+            worst, error, failed = compare_odds([fief.EXACT_CACHE.outcome(battle)], [(w, t, l, s)], limit)
+            if failed:
+                failures.append((store.__name__, a, b, (w, t, l)))
+    return failures
+
+def compare_pieces(reference, pieces):
+    mismatches = {}
+    for name, expected in reference.items():
+        cases = damage_cases() if name == "apply_damage" else dice_cases()
+        wrong = [(case, want, got) for case, want, got in zip(cases, expected, pieces[name]) if want != got]
+        mismatches[name] = (len(expected), wrong)
+    return mismatches
+
+def binomial_test(k, n, p):
+    # two-sided exact p-value of k successes in n trials: twice the smaller tail, capped at 1
+    def pmf(i):
+        return math.exp(math.lgamma(n + 1) - math.lgamma(i + 1) - math.lgamma(n - i + 1) + i * math.log(p) + (n - i) * math.log1p(-p))
+    tail = sum(pmf(i) for i in range(k + 1)) if k < n * p else sum(pmf(i) for i in range(k, n + 1))
+    return min(1.0, 2 * tail)
+
+def compare_odds(reference, results, limit):
+    # exact binomial test of every outcome count against the exact odds; certain outcomes must match exactly
+    worst, error, failures = 1.0, 0.0, []
+    for cell, (expected, observed) in enumerate(zip(reference, results)):
+        n = observed[3]
+        failed = False
+        for p, p_hat in zip(expected[:3], observed[:3]):
+            if math.isinf(n) or p <= 0 or p >= 1:
+                pvalue = 1.0 if abs(p - p_hat) < 1e-9 else 0.0
+            else:
+                pvalue = binomial_test(round(p_hat * n), n, p)
+            worst = min(worst, pvalue)
+            failed = failed or pvalue < limit
+        error += abs(observed[0] - expected[0])
+        if failed:
+            failures.append(cell)
+    return worst, error / len(reference), failures
+
+def run(iterations = 2000, alpha = 0.01, seed = 1429, engines = None, out = print):
+    random.seed(seed)
+    cells = grid()
+    available = available_engines()
+    names = engines if engines is not None else list(available)
+    limit = alpha / (3 * len(cells)) # Bonferroni over cells and outcomes
+
+    reference = exact_engine(cells, iterations)
+    reference_pieces = python_pieces(fief)
+    report = []
+    failed = False
+    for name in names:
+        kind, engine = available[name]
+        if name == "javascript":
+            output = run_javascript(cells, iterations)
+            results = [tuple(r) + (iterations,) for r in output["battles"]]
+            seconds = output["seconds"]
+            pieces = output
+        else:
+            start = time.perf_counter()
+            results = engine(cells, iterations)
+            seconds = time.perf_counter() - start
+            pieces = python_pieces(battlesimulation) if name == "battlesimulation" else reference_pieces
+        worst, error, failures = compare_odds(reference, results, limit)
+        known = []
+        if name in KNOWN_DIVERGENCES:
+            reason, settle = KNOWN_DIVERGENCES[name]
+            known = [cell for cell in failures
+                     if not compare_odds([settled_odds(*cells[cell], settle)], [results[cell]], limit)[2]]
+            failures = [cell for cell in failures if cell not in known]
+        mismatches = compare_pieces(reference_pieces, pieces)
+        failed = failed or bool(failures) or any(wrong for total, wrong in mismatches.values())
+        report.append((name, kind, seconds, worst, error, known, failures, mismatches))
+    cache_failures = cache_checks(limit)
+    failed = failed or bool(cache_failures)
+
+    out(f"{len(cells)} cells, {iterations} samples per cell, p-value limit {limit:.2g} (alpha {alpha})")
+    out(f"{'engine':<18}{'kind':<9}{'seconds':>9}{'min p':>10}{'mean |dw|':>11}{'known cells':>13}{'failed cells':>14}{'damage':>10}{'dice':>8}")
+    for name, kind, seconds, worst, error, known, failures, mismatches in report:
+        damage = len(mismatches["apply_damage"][1])
+        dice = len(mismatches["dice"][1])
+        out(f"{name:<18}{kind:<9}{seconds:>9.2f}{worst:>10.2g}{error:>11.4f}{len(known):>13}{len(failures):>14}{damage:>10}{dice:>8}")
+    for name, kind, seconds, worst, error, known, failures, mismatches in report:
+        if known:
+            out(f"{name} (known, {len(known)} cells): {KNOWN_DIVERGENCES[name][0]}")
+        for cell in failures[:3]:
+            a, b = cells[cell]
+            out(f"{name}: cell a={a} b={b} exact={tuple(round(p, 4) for p in reference[cell][:3])}")
+        for piece, (total, wrong) in mismatches.items():
+            for case, want, got in wrong[:3]:
+                out(f"{name}: {piece}{case} expected {want}, got {got}")
+    out(f"cache checks: {len(CACHE_CHECKS) * 2 - len(cache_failures)}/{len(CACHE_CHECKS) * 2} plain matchups match the exact odds")
+    for store, a, b, odds in cache_failures:
+        out(f"{store}: a={a} b={b} got {tuple(round(p, 4) for p in odds)}")
+    return not failed
@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+
+from fief_army_simulation import ArmyLeader, BattleMemo, DefensiveStructure, matchups, odds_rows, write_rows
+
+
+def export(args):
+    memo = BattleMemo(args.memo_max_entries, args.memo_max_samples, args.memo) if args.memo else None
+    rows = odds_rows(
+        matchups(args.attacker_min, args.attacker_max, [DefensiveStructure[s] for s in args.structures], [ArmyLeader[l] for l in args.leaders]),
+        args.workers,
+        args.buffer,
+        memo,
+    )
+    try:
+        if args.output == "-":
+            write_rows(rows, sys.stdout, args.format)
+        else:
+            with open(args.output, 'w', newline='', encoding='ascii') as f:
+                write_rows(rows, f, args.format)
+    finally:
+        if memo is not None:
+            memo.save()
+
+
+def conformance(args):
+    import conformance
+    if not conformance.run(args.iterations, args.alpha, args.seed, args.engines):
+        sys.exit(1)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog="python -m fief", description="Odds calculator for the Fief boardgame")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("export", help="stream the odds table as CSV or NDJSON")
+    p.add_argument("-o", "--output", default="-", help="output path, '-' for stdout (default)")
+    p.add_argument("-f", "--format", choices=["csv", "ndjson"], default="csv")
+    p.add_argument("-j", "--workers", type=int, default=None, help="worker processes, 1 runs inline (default: one per CPU)")
+    p.add_argument("--buffer", type=int, default=64, help="matchups in flight at once (default: 64)")
+    p.add_argument("--attacker-min", type=int, default=0, help="minimum attacker strength points")
+    p.add_argument("--attacker-max", type=int, default=None, help="maximum attacker strength points")
+    p.add_argument("--structures", nargs="+", choices=[s.name for s in DefensiveStructure], default=[s.name for s in DefensiveStructure], help="defender structures")
+    p.add_argument("--leaders", nargs="+", choices=[l.name for l in ArmyLeader], default=["LORD_OR_TITLED_LADY", "NONE_OR_LADY"], help="leaders on either side")
+    p.add_argument("--memo", default=None, help="persist battle results to this path between runs")
+    p.add_argument("--memo-max-entries", type=int, default=None, help="most results kept in the memo (default: unbounded)")
+    p.add_argument("--memo-max-samples", type=int, default=None, help="most simulated battles kept in the memo (default: unbounded)")
+    p.set_defaults(run=export)
+
+    p = commands.add_parser("conformance", help="check every available engine against the exact odds")
+    p.add_argument("-n", "--iterations", type=int, default=2000, help="samples per cell for sampled engines (default: 2000)")
+    p.add_argument("--alpha", type=float, default=0.01, help="family-wise false alarm rate (default: 0.01)")
+    p.add_argument("--seed", type=int, default=1429)
+    p.add_argument("--engines", nargs="+", default=None, help="engines to run (default: all available)")
+    p.set_defaults(run=conformance)
+
+    args = parser.parse_args(argv)
+    try:
+        args.run(args)
+    except BrokenPipeError:
+        # the reader went away, e.g. `| head`; keep the interpreter from failing on flush at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,7 +22,7 @@ class ArmyLeader(Enum):
     
 
 BIN_SIZE_DAMAGE_STRATEGY = len(bin(DamageStrategy.KNIGHTS_FIRST.value)) - 2
-BIN_SIZE_ARMY_LEADER = len(bin(ArmyLeader.LORD_OR_TITLED_LADY.value)) - 2
+BIN_SIZE_ARMY_LEADER = len(bin(ArmyLeader.DARC.value)) - 2
 BIN_SIZE_DEFENSIVE_STRUCTURE = len(bin(DefensiveStructure.FORTIFIED_CITY.value)) - 2
 
 @dataclass
@@ -140,23 +140,101 @@ class Army:
 
 BIN_SIZE_ARMY = BIN_SIZE_MEN_AT_ARMS + BIN_SIZE_KNIGHTS + BIN_SIZE_DEFENSIVE_STRUCTURE + BIN_SIZE_ARMY_LEADER
 
-import random, copy
+import random, copy, math, json, os, hashlib
+from array import array
+from collections import OrderedDict
 
 @dataclass
 class BattleDiceSet:
     dice: int = 1
 
-    def roll(self, dice_bonus = 0):
+    def roll(self, dice_bonus = 0, stream = None):
+        if stream is not None:
+            return sum(stream.take(self.dice)) + self.dice * dice_bonus
         d = 0
         for i in range(self.dice):
             d += random.randint(1, 3)
             d += dice_bonus
         return d
 
+    def distribution(self, dice_bonus = 0):
+        totals = {0: 1.0}
+        for i in range(self.dice):
+            rolled = {}
+            for total, p in totals.items():
+                for r in range(1, 4):
+                    t = total + r + dice_bonus
+                    rolled[t] = rolled.get(t, 0.0) + p / 3
+            totals = rolled
+        return totals
+
 DICE_SETS = {0: BattleDiceSet(0), 1: BattleDiceSet(1), 2: BattleDiceSet(2), 3: BattleDiceSet(3), 4: BattleDiceSet(4)}
 
+class DiceStream:
+    # replayable d3 rolls, so compared battles can consume the same dice
+
+    def __init__(self, antithetic = False):
+        self.rolls = []
+        self.position = 0
+        self.antithetic = antithetic
+
+    def mirrored(self):
+        stream = DiceStream(not self.antithetic)
+        stream.rolls = self.rolls
+        return stream
+
+    def rewind(self):
+        self.position = 0
+
+    def take(self, dice):
+        block = max(DICE_SETS) # every round consumes a full block, keeping rounds aligned across battles
+        while len(self.rolls) < self.position + block:
+            self.rolls.append(random.randint(1, 3))
+        rolls = self.rolls[self.position:self.position + dice]
+        self.position += block
+        if self.antithetic:
+            return [4 - r for r in rolls]
+        return rolls
+
 class BattleStopRule(Enum):
     ANNIHILATION = 0
+    MAX_ROUNDS = 1
+    STRENGTH_BELOW = 2
+    RELATIVE_STRENGTH_BELOW = 3
+    ODDS_BELOW = 4
+
+RETREAT = "retreat" # indicator of an attacker retreat, next to 1 (win), 0 (tie) and -1 (loss); never a point count
+
+@dataclass(frozen=True)
+class BattleStop:
+    # a stop rule with its parameter, the attacker retreats once it applies
+    rule: BattleStopRule = BattleStopRule.ANNIHILATION
+    value: float = None
+
+    def __post_init__(self):
+        if self.rule != BattleStopRule.ANNIHILATION and self.value is None:
+            raise Exception(f"{self.rule.name} needs a value, use BattleStop({self.rule}, value)")
+
+    def retreats(self, battle, rounds):
+        a = battle.a
+        b = battle.b
+        if self.rule == BattleStopRule.ANNIHILATION:
+            return False
+        if self.rule == BattleStopRule.MAX_ROUNDS:
+            return rounds >= self.value
+        if self.rule == BattleStopRule.STRENGTH_BELOW:
+            return a.army_points() < self.value
+        if self.rule == BattleStopRule.RELATIVE_STRENGTH_BELOW:
+            return a.army_points() < self.value * b.army_points()
+        if self.rule == BattleStopRule.ODDS_BELOW:
+            state = Battle(copy.copy(a), copy.copy(b), battle.a_strategy, battle.b_strategy, battle.cavalcade)
+            return EXACT_CACHE.outcome(state)[0] < self.value
+        raise Exception("Unknown stop rule")
+
+def battle_stop(stop_rule):
+    if isinstance(stop_rule, BattleStop):
+        return stop_rule
+    return BattleStop(stop_rule)
 
 @dataclass
 class Battle:
@@ -213,7 +291,8 @@ class Battle:
                 return "resolved", "failure", 1
         return "ongoing", ai.army_points(), bi.army_points()
 
-    def battle_iterator(self):
+    def battle_iterator(self, a_stream = None, b_stream = None, stop_rule = BattleStopRule.ANNIHILATION, rounds = 0):
+        stop = battle_stop(stop_rule)
         while True:
             ai = self.a
             bi = self.b
@@ -231,8 +310,8 @@ class Battle:
                 elif dcB == 0:
                     yield "resolved", "failure", 1
                 break
-            dA = DICE_SETS[dcA].roll()
-            dB = DICE_SETS[dcB].roll(1 if self.cavalcade else 0)
+            dA = DICE_SETS[dcA].roll(0, a_stream)
+            dB = DICE_SETS[dcB].roll(1 if self.cavalcade else 0, b_stream)
             ai.apply_damage(dB, astrat)
             bi.apply_damage(dA, bstrat)
             if ai.is_defeated() or bi.is_defeated():
@@ -243,59 +322,67 @@ class Battle:
                 elif bi.is_defeated():
                     yield "resolved", "failure", 1
                 break
+            rounds += 1
+            if stop.retreats(self, rounds):
+                yield "resolved", "retreat", RETREAT
+                break
             yield "ongoing", ai.army_points(), bi.army_points()
 
-    def resolve(self):
+    def resolve(self, a_stream = None, b_stream = None, stop_rule = BattleStopRule.ANNIHILATION):
         result = None
-        for step in self.battle_iterator():
+        for step in self.battle_iterator(a_stream, b_stream, stop_rule):
             result = step
         return result
 
 class BattleCache:
 
-    def __init__(self):
+    def __init__(self, stop_rule = BattleStopRule.ANNIHILATION):
         self.db = {}
+        self.stop = battle_stop(stop_rule)
+
+    def key(self, battle: Battle, rounds):
+        # a round limit makes the outcome depend on the rounds already fought
+        if self.stop.rule == BattleStopRule.MAX_ROUNDS:
+            return battle, rounds
+        return battle
+
+    def counts(self, battle: Battle, rounds = 0):
+        return self.db.get(self.key(battle, rounds), (0, 0, 0, 0))
+
+    def record(self, battle: Battle, indicator, rounds = 0):
+        w, t, l, s = self.counts(battle, rounds)
+        if indicator == 1:
+            w += 1
+        elif indicator == 0:
+            t += 1
+        elif indicator == -1:
+            l += 1
+        elif indicator != RETREAT: # retreats are the samples left over
+            raise Exception(battle, indicator)
+        self.db[self.key(battle, rounds)] = w, t, l, s + 1
+
+    def items(self):
+        if self.stop.rule != BattleStopRule.MAX_ROUNDS:
+            return self.db.items()
+        return ((key[0], data) for key, data in self.db.items() if key[1] == 0)
 
     def probability(self, battle: Battle):
-        w, t, l, s = self.db.get(battle, (0, 0, 0, 0))
+        w, t, l, s = self.counts(battle)
         return w / s, l / s, t / s, s
 
-    def resolve(self, battle: Battle):
-        w, t, l, s = self.db.get(battle, (0, 0, 0, 0))
+    def resolve(self, battle: Battle, rounds = 0):
+        w, t, l, s = self.counts(battle, rounds)
         if s < 1000: #reliability number
             b = copy.deepcopy(battle)
             status, res, indicator = b.battle_status()
-            if status == "resolved":
-                if indicator == 1:
-                    w += 1
-                    s += 1
-                elif indicator == 0:
-                    t += 1
-                    s += 1
-                elif indicator == -1:
-                    l += 1
-                    s += 1
-                else:
-                    raise Exception()
-                self.db[battle] = w, t, l, s
-                return indicator
-            next(b.battle_iterator())
-            indicator = self.resolve(b)
-            if indicator == 1:
-                w += 1
-                s += 1
-            elif indicator == 0:
-                t += 1
-                s += 1
-            elif indicator == -1:
-                l += 1
-                s += 1
-            else:
-                raise Exception(b, indicator)
-            self.db[battle] = w, t, l, s
+            if status != "resolved":
+                status, res, indicator = next(b.battle_iterator(stop_rule=self.stop, rounds=rounds))
+                if status != "resolved" or indicator != RETREAT: # an ongoing step carries army points, not an indicator
+                    indicator = self.resolve(b, rounds + 1)
+            self.record(battle, indicator, rounds)
             return indicator
         # if more than 1000 times simulated, return rng based result
-        return random.sample(population=[1, 0, -1], k=1, counts=[w, t, l])[0]
+        return random.sample(population=[1, 0, -1, RETREAT], k=1, counts=[w, t, l, s - w - t - l])[0]
 
     def populate(self, report_iteration = 1000):
         iteration = 0
@@ -315,7 +402,7 @@ class BattleCache:
     def complete(self, limit = 1000, reverse = False, report_iteration = 1000):
         from datetime import datetime
         previous = datetime.now()
-        items = sorted(self.db.items(), key=lambda x: x[1][3], reverse=reverse)
+        items = sorted(self.items(), key=lambda x: x[1][3], reverse=reverse)
         battles = list(battle for battle, data in items)
         iteration = 0
         for i, battle in enumerate(battles):
@@ -325,18 +412,17 @@ class BattleCache:
                 previous = now
                 print(f"battles completed: {i} in {x} seconds", end='\n')
             iteration += 1
-            data = self.db[battle]
-            w, t, l, s = data
+            w, t, l, s = self.counts(battle)
             for i in range(limit - s):
                 self.resolve(battle)
 
     def serialize(self, path: str = "battle_odds.csv"):
         with open(path, 'w', newline='', encoding='ascii') as f:
             writer = csv.writer(f)
-            headers = ["a_men", "a_knights", "a_leader", "a_strength", "a_structure", "b_men", "b_knights", "b_leader", "b_strength", "b_structure", "a_win_rate", "b_win_rate", "tie_rate"]
+            headers = ["a_men", "a_knights", "a_leader", "a_strength", "a_structure", "b_men", "b_knights", "b_leader", "b_strength", "b_structure", "a_win_rate", "b_win_rate", "tie_rate", "retreat_rate"]
             writer.writerow(headers)
 
-            for battle, data in self.db.items():
+            for battle, data in self.items():
                 w, t, l, s = data
                 wa = w / s
                 ti = t / s
@@ -344,58 +430,391 @@ class BattleCache:
                 a = battle.a
                 b = battle.b
                 
-                writer.writerow([a.men_at_arms, a.knights, a.leader.name, a.strength_points(), a.structure.name, b.men_at_arms, b.knights, b.leader.name, b.strength_points(), b.structure.name, wa, wb, ti])
+                writer.writerow([a.men_at_arms, a.knights, a.leader.name, a.strength_points(), a.structure.name, b.men_at_arms, b.knights, b.leader.name, b.strength_points(), b.structure.name, wa, wb, ti, 1 - wa - ti - wb])
+
+ARMY_STATES = (MAX_MEN_AT_ARMS + 1) * (MAX_KNIGHTS + 1) * len(DefensiveStructure) * len(ArmyLeader)
+BATTLE_STATES = ARMY_STATES * ARMY_STATES * len(DamageStrategy) * len(DamageStrategy) * 2
+
+class ArrayBattleCache(BattleCache):
+    # (w, t, l, s) counters of every battle state live in one preallocated
+    # unsigned int array, four slots per dense state index
+
+    def __init__(self, stop_rule = BattleStopRule.ANNIHILATION):
+        self.stop = battle_stop(stop_rule)
+        if self.stop.rule == BattleStopRule.MAX_ROUNDS:
+            raise Exception("MAX_ROUNDS needs the rounds fought in the state index, use BattleCache")
+        self.db = array('I', [0]) * (4 * BATTLE_STATES)
+
+    def army_index(self, army: Army):
+        if army.men_at_arms > MAX_MEN_AT_ARMS:
+            raise Exception("Too many men-at-arms")
+        if army.knights > MAX_KNIGHTS:
+            raise Exception("Too many knights")
+        i = army.leader.value
+        i = i * len(DefensiveStructure) + army.structure.value
+        i = i * (MAX_KNIGHTS + 1) + army.knights
+        i = i * (MAX_MEN_AT_ARMS + 1) + army.men_at_arms
+        return i
+
+    def army(self, index):
+        index, men_at_arms = divmod(index, MAX_MEN_AT_ARMS + 1)
+        index, knights = divmod(index, MAX_KNIGHTS + 1)
+        leader, structure = divmod(index, len(DefensiveStructure))
+        return Army(men_at_arms, knights, DefensiveStructure(structure), ArmyLeader(leader))
+
+    def index(self, battle: Battle):
+        i = self.army_index(battle.a)
+        i = i * ARMY_STATES + self.army_index(battle.b)
+        i = i * len(DamageStrategy) + battle.a_strategy.value
+        i = i * len(DamageStrategy) + battle.b_strategy.value
+        i = i * 2 + (1 if battle.cavalcade else 0)
+        return i
+
+    def battle(self, index):
+        index, cavalcade = divmod(index, 2)
+        index, b_strategy = divmod(index, len(DamageStrategy))
+        index, a_strategy = divmod(index, len(DamageStrategy))
+        a, b = divmod(index, ARMY_STATES)
+        return Battle(self.army(a), self.army(b), DamageStrategy(a_strategy), DamageStrategy(b_strategy), cavalcade == 1)
+
+    def counts(self, battle: Battle, rounds = 0):
+        i = 4 * self.index(battle)
+        return tuple(self.db[i:i + 4])
+
+    def record(self, battle: Battle, indicator, rounds = 0):
+        i = 4 * self.index(battle)
+        if indicator == 1:
+            self.db[i] += 1
+        elif indicator == 0:
+            self.db[i + 1] += 1
+        elif indicator == -1:
+            self.db[i + 2] += 1
+        elif indicator != RETREAT:
+            raise Exception(battle, indicator)
+        self.db[i + 3] += 1
+
+    def items(self):
+        for index, s in enumerate(self.db[3::4]):
+            if s > 0:
+                yield self.battle(index), tuple(self.db[4 * index:4 * index + 4])
+
+class ExactBattleCache(BattleCache):
+    # odds are solved over the full dice distribution instead of sampled,
+    # each entry is stored as a single sample weighted by its probabilities
 
-BATTLE_CACHE = BattleCache()
+    def __init__(self):
+        super().__init__()
+        self.distributions = {}
+
+    def distribution(self, dice, dice_bonus = 0):
+        key = dice, dice_bonus
+        if key not in self.distributions:
+            self.distributions[key] = list(DICE_SETS[dice].distribution(dice_bonus).items())
+        return self.distributions[key]
+
+    def damaged(self, army, strategy, dice, dice_bonus = 0):
+        armies = {}
+        for damage, p in self.distribution(dice, dice_bonus):
+            x = copy.copy(army)
+            x.apply_damage(damage, strategy)
+            key = x.men_at_arms, x.knights
+            if key in armies:
+                armies[key] = armies[key][0], armies[key][1] + p
+            else:
+                armies[key] = x, p
+        return armies.values()
+
+    def outcome(self, battle: Battle):
+        if battle in self.db:
+            return self.db[battle]
+        status, res, indicator = battle.battle_status()
+        if status == "resolved":
+            w, t, l = indicator == 1, indicator == 0, indicator == -1
+            self.db[battle] = float(w), float(t), float(l), 1
+            return self.db[battle]
+        ai = battle.a
+        bi = battle.b
+        dcA = ai.dice(bi.attacker_penalty())
+        dcB = bi.dice(ai.attacker_penalty())
+        w, t, l, stay = 0.0, 0.0, 0.0, 0.0
+        for an, pa in self.damaged(ai, battle.a_strategy, dcB, 1 if battle.cavalcade else 0):
+            for bn, pb in self.damaged(bi, battle.b_strategy, dcA):
+                p = pa * pb
+                if an == ai and bn == bi:
+                    stay += p # nobody lost a unit, the round is rolled again
+                elif an.is_defeated() and bn.is_defeated():
+                    t += p
+                elif an.is_defeated():
+                    l += p
+                elif bn.is_defeated():
+                    w += p
+                else:
+                    nw, nt, nl, ns = self.outcome(Battle(an, bn, battle.a_strategy, battle.b_strategy, battle.cavalcade))
+                    w += p * nw
+                    t += p * nt
+                    l += p * nl
+        self.db[battle] = w / (1 - stay), t / (1 - stay), l / (1 - stay), 1
+        return self.db[battle]
+
+    def probability(self, battle: Battle):
+        w, t, l, s = self.outcome(battle)
+        return w / s, l / s, t / s, s
+
+    def resolve(self, battle: Battle):
+        w, t, l, s = self.outcome(battle)
+        return random.choices(population=[1, 0, -1], weights=[w, t, l])[0]
+
+    def complete(self, limit = 1000, reverse = False, report_iteration = 1000):
+        pass # every solved battle is already exact
+
+MARGINAL_STEPS = [
+    ("a", "men_at_arms", 1), ("a", "men_at_arms", -1), ("a", "knights", 1), ("a", "knights", -1),
+    ("b", "men_at_arms", 1), ("b", "men_at_arms", -1), ("b", "knights", 1), ("b", "knights", -1),
+]
 
-def battle(a: Army, b: Army, stop_rule = BattleStopRule.ANNIHILATION):
+class MarginalCache:
+    # change in the attacker's win rate for each of MARGINAL_STEPS,
+    # taken from neighbouring cells of an exact odds table
+
+    def __init__(self, odds: ExactBattleCache = None):
+        self.odds = odds if odds is not None else ExactBattleCache()
+        self.db = {}
+
+    def neighbour(self, battle: Battle, side, unit, step):
+        n = Battle(copy.copy(battle.a), copy.copy(battle.b), battle.a_strategy, battle.b_strategy, battle.cavalcade)
+        army = getattr(n, side)
+        value = getattr(army, unit) + step
+        if value < 0 or value > (MAX_MEN_AT_ARMS if unit == "men_at_arms" else MAX_KNIGHTS):
+            return None
+        setattr(army, unit, value)
+        return n
+
+    def probability(self, battle: Battle):
+        if battle not in self.db:
+            w = self.odds.outcome(battle)[0]
+            deltas = []
+            for side, unit, step in MARGINAL_STEPS:
+                n = self.neighbour(battle, side, unit, step)
+                deltas.append(None if n is None else self.odds.outcome(n)[0] - w)
+            self.db[battle] = tuple(deltas)
+        return self.db[battle]
+
+    def populate(self, report_iteration = 1000):
+        iteration = 0
+        for a_lord in range(2, -1, -1):
+            for a_kn in range(8, -1, -1):
+                for a_maa in range(13, -1, -1):
+                    for b_lord in range(2, -1, -1):
+                        for b_defensive in range(2, -1, -1):
+                            for b_kn in range(8, -1, -1):
+                                for b_maa in range(13, -1, -1):
+                                    if iteration % report_iteration == 0:
+                                        print(f"iteration: {iteration}", end='\r')
+                                    iteration += 1
+                                    a, b = Army(a_maa, a_kn, DefensiveStructure.NONE, ArmyLeader(a_lord)), Army(b_maa, b_kn, DefensiveStructure(b_defensive), ArmyLeader(b_lord))
+                                    self.probability(Battle(a, b))
+
+    def serialize(self, path: str = "marginal_odds.csv"):
+        with open(path, 'w', newline='', encoding='ascii') as f:
+            writer = csv.writer(f)
+            headers = ["a_men", "a_knights", "a_leader", "a_structure", "b_men", "b_knights", "b_leader", "b_structure", "a_win_rate"]
+            headers += [f"{side}_{unit}_{step:+d}" for side, unit, step in MARGINAL_STEPS]
+            writer.writerow(headers)
+
+            for battle, deltas in self.db.items():
+                a = battle.a
+                b = battle.b
+                wa = self.odds.outcome(battle)[0]
+                writer.writerow([a.men_at_arms, a.knights, a.leader.name, a.structure.name, b.men_at_arms, b.knights, b.leader.name, b.structure.name, wa] + ["" if d is None else d for d in deltas])
+
+BATTLE_CACHE = BattleCache()
+EXACT_CACHE = ExactBattleCache()
+
+MEMO_VERSION = 2 # bump when battle() changes in ways the rules fingerprint cannot see
+
+class BattleMemo:
+    # least recently used standalone battle() results, keyed by packed matchup;
+    # every entry keeps a fingerprint of the rules it was simulated under,
+    # so after a rules tweak only the matchups it affects are simulated again
+
+    def __init__(self, max_entries = None, max_samples = None, path = None):
+        # unbounded unless limited: a memo smaller than the matchups scanned in a fixed
+        # order evicts every entry before the next run reaches it
+        self.db = OrderedDict()
+        self.samples = 0
+        self.max_entries = max_entries
+        self.max_samples = max_samples
+        self.path = path
+        self.rules = {}
+        self.dice = repr([sorted(DICE_SETS[n].distribution(bonus).items()) for n in DICE_SETS for bonus in range(2)])
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def key(self, a: Army, b: Army, stop_rule, iterations):
+        stop = battle_stop(stop_rule)
+        return (a.hash() << BIN_SIZE_ARMY) | b.hash(), stop.rule.value, stop.value, iterations
+
+    def army_rules(self, army: Army):
+        h = army.hash()
+        if h not in self.rules:
+            row = [army.army_points(), army.attacker_penalty()]
+            row += [army.dice(penalty) for penalty in range(-2, 1)]
+            for damage in range(1, 4 * max(DICE_SETS) + 1):
+                row += army.compute_damage_maa_first(damage)
+                row += army.compute_damage_knights_first(damage)
+            rows = [tuple(row)]
+            for men_at_arms in range(army.men_at_arms + 1):
+                for knights in range(army.knights + 1):
+                    if men_at_arms < army.men_at_arms or knights < army.knights:
+                        rows.append(self.army_rules(Army(men_at_arms, knights, army.structure, army.leader)))
+            self.rules[h] = hashlib.sha1(repr(rows).encode('ascii')).hexdigest()
+        return self.rules[h]
+
+    def fingerprint(self, a: Army, b: Army):
+        return hashlib.sha1(repr((MEMO_VERSION, self.dice, self.army_rules(a), self.army_rules(b))).encode('ascii')).hexdigest()
+
+    def get(self, a: Army, b: Army, stop_rule, iterations):
+        key = self.key(a, b, stop_rule, iterations)
+        entry = self.db.get(key)
+        if entry is None or entry[0] != self.fingerprint(a, b):
+            return None
+        self.db.move_to_end(key)
+        return entry[1]
+
+    def put(self, a: Army, b: Army, stop_rule, iterations, result):
+        key = self.key(a, b, stop_rule, iterations)
+        if key in self.db:
+            self.samples -= key[3]
+        self.db[key] = self.fingerprint(a, b), result
+        self.db.move_to_end(key)
+        self.samples += iterations
+        self.evict()
+
+    def evict(self):
+        while self.db and ((self.max_entries is not None and len(self.db) > self.max_entries) or (self.max_samples is not None and self.samples > self.max_samples)):
+            key, entry = self.db.popitem(last=False)
+            self.samples -= key[3]
+
+    def load(self, path):
+        with open(path, 'r', encoding='ascii') as f:
+            for key, fingerprint, result in json.load(f):
+                self.db[tuple(key)] = fingerprint, tuple(result)
+                self.samples += key[3]
+        self.evict()
+
+    def save(self, path = None):
+        path = path if path is not None else self.path
+        if path is None:
+            return
+        with open(path, 'w', encoding='ascii') as f:
+            json.dump([[list(key), fingerprint, list(result)] for key, (fingerprint, result) in self.db.items()], f)
+
+MEMO_MAX_ENTRIES = 100000 # in-memory default for BATTLE_MEMO, which is not persisted
+
+BATTLE_MEMO = BattleMemo(MEMO_MAX_ENTRIES)
+
+def battle(a: Army, b: Army, stop_rule = BattleStopRule.ANNIHILATION, memo = BATTLE_MEMO):
+    # (a_win_rate, tie_rate, b_win_rate, retreat_rate) for every stop rule
     iterations = 1000
-    resultsA = [0] * iterations
-    resultsB = [0] * iterations
+    if memo is not None:
+        result = memo.get(a, b, stop_rule, iterations)
+        if result is not None:
+            return result
+    result = battle_outcomes(a, b, [stop_rule], iterations)[stop_rule]
+    if memo is not None:
+        memo.put(a, b, stop_rule, iterations, result)
+    return result
+
+def battle_outcomes(a: Army, b: Army, stop_rules, iterations = 1000):
+    # a single pass fought to annihilation serves every stop rule,
+    # each rule retreats at the first round it applies
+    stops = [battle_stop(rule) for rule in stop_rules]
+    results = [[0, 0, 0, 0] for stop in stops]
+    retreat_rules = any(stop.rule != BattleStopRule.ANNIHILATION for stop in stops)
     penaltyA = b.attacker_penalty()
     penaltyB = a.attacker_penalty()
 
-    winA = 0
-    ties = 0
-    winB = 0
-
     for i in range(iterations):
         ai = copy.copy(a)
         bi = copy.copy(b)
+        retreated = [False] * len(stops)
+        remaining = len(stops)
+        rounds = 0
         while True:
             dcA = ai.dice(penaltyA)
             dcB = bi.dice(penaltyB)
             if dcA == 0 or dcB == 0:
                 if dcA == 0 and dcB == 0:
-                    ties += 1
+                    outcome = 1
                 elif dcA == 0:
-                    winB += 1
+                    outcome = 2
                 elif dcB == 0:
-                    winA += 1
+                    outcome = 0
                 break
             dA = DICE_SETS[dcA].roll()
             dB = DICE_SETS[dcB].roll()
             ai.apply_damage(dB, DamageStrategy.MEN_AT_ARMS_FIRST)
             bi.apply_damage(dA, DamageStrategy.MEN_AT_ARMS_FIRST)
-            resultsA[i], resultsB[i] = ai.army_points(), bi.army_points()
             if ai.is_defeated() or bi.is_defeated():
                 if ai.is_defeated() and bi.is_defeated():
-                    ties += 1
+                    outcome = 1
                 elif ai.is_defeated():
-                    winB += 1
+                    outcome = 2
                 elif bi.is_defeated():
-                    winA += 1
+                    outcome = 0
                 break
+            if not retreat_rules:
+                continue
+            rounds += 1
+            state = Battle(ai, bi)
+            for j, stop in enumerate(stops):
+                if not retreated[j] and stop.retreats(state, rounds):
+                    retreated[j] = True
+                    remaining -= 1
+            if remaining == 0:
+                outcome = None
+                break
+        for j in range(len(stops)):
+            results[j][3 if retreated[j] else outcome] += 1
 
-    return winA / iterations, ties / iterations, winB / iterations
+    return {rule: tuple(r / iterations for r in result) for rule, result in zip(stop_rules, results)}
+
+def paired_battle(x: Battle, y: Battle, iterations = 1000, antithetic = False):
+    # difference in attacker win rate between x and y, and its standard error
+    if iterations < 2:
+        raise Exception("paired_battle needs at least 2 iterations to estimate a standard error")
+    diffs = []
+    for i in range(iterations):
+        a_stream, b_stream = DiceStream(), DiceStream()
+        streams = [(a_stream, b_stream)]
+        if antithetic:
+            streams.append((a_stream.mirrored(), b_stream.mirrored()))
+        d = 0
+        for a_s, b_s in streams:
+            for battle, sign in ((x, 1), (y, -1)):
+                a_s.rewind()
+                b_s.rewind()
+                status, res, indicator = copy.deepcopy(battle).resolve(a_s, b_s)
+                if indicator == 1:
+                    d += sign
+        diffs.append(d / len(streams))
+    mean = sum(diffs) / iterations
+    variance = sum((d - mean) ** 2 for d in diffs) / (iterations - 1)
+    return mean, math.sqrt(variance / iterations)
 
 import csv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+ODDS_HEADERS = ["a_men", "a_knights", "a_leader", "a_structure", "b_men", "b_knights", "b_leader", "b_structure", "a_win_rate", "b_win_rate", "tie_rate"]
+
+def odds_row(a, b, wa, ti, wb):
+    return [a.men_at_arms, a.knights, a.leader.name, a.structure.name, b.men_at_arms, b.knights, b.leader.name, b.structure.name, wa, wb, ti]
 
-def write_csv(combinations):
-    with open("odds.csv", 'w', newline='', encoding='ascii') as f:
+def write_csv(combinations, memo = BATTLE_MEMO, path = "odds.csv"):
+    with open(path, 'w', newline='', encoding='ascii') as f:
         writer = csv.writer(f)
-        headers = ["a_men", "a_knights", "a_leader", "a_structure", "b_men", "b_knights", "b_leader", "b_structure", "a_win_rate", "b_win_rate", "tie_rate"]
-        writer.writerow(headers)
+        writer.writerow(ODDS_HEADERS)
 
     
         for i in range(len(combinations)):
@@ -409,12 +828,14 @@ def write_csv(combinations):
                 a, b = combinations[i], combinations[j]
                 if a.strength_points() < b.strength_points():
                     continue # players will never consider attacking such an opponent
-                wa, ti, wb = battle(a, b)
-                writer.writerow([a.men_at_arms, a.knights, a.leader.name, a.structure.name, b.men_at_arms, b.knights, b.leader.name, b.structure.name, wa, wb, ti])
+                wa, ti, wb, retreats = battle(a, b, memo=memo)
+                writer.writerow(odds_row(a, b, wa, ti, wb))
                 #if wa >= 0.95:
                 #    losing = True # effectively all lower evaluated battles will be pointless to evaluate
+    if memo is not None:
+        memo.save()
 
-def evaluate_b_combinations(a):
+def evaluate_b_combinations(a, memo = BATTLE_MEMO):
     for lord in range(1, -1, -1):
         for defensive in range(2, -1, -1):
             for kn in range(8, -1, -1):
@@ -422,25 +843,94 @@ def evaluate_b_combinations(a):
                     b = Army(maa, kn, DefensiveStructure(defensive), ArmyLeader(lord))
                     if a.strength_points() < b.strength_points():
                         break
-                    wa, ti, wb = battle(a, b)
+                    wa, ti, wb, retreats = battle(a, b, memo=memo)
                     yield a, b, wa, ti, wb
                     if wa >= 0.95:
                         break
     
-def write_combinations():
-    with open("odds.csv", 'w', newline='', encoding='ascii') as f:
+def write_combinations(memo = BATTLE_MEMO, path = "odds.csv"):
+    with open(path, 'w', newline='', encoding='ascii') as f:
         writer = csv.writer(f)
-        headers = ["a_men", "a_knights", "a_leader", "a_structure", "b_men", "b_knights", "b_leader", "b_structure", "a_win_rate", "b_win_rate", "tie_rate"]
-        writer.writerow(headers)    
+        writer.writerow(ODDS_HEADERS)
 
         for lord in range(1, -1, -1):
             for kn in range(8, -1, -1):
                 for maa in range(13, -1, -1):
-                    for a, b, wa, ti, wb in evaluate_b_combinations(Army(maa, kn, DefensiveStructure.NONE, ArmyLeader(lord))):
-                        writer.writerow([a.men_at_arms, a.knights, a.leader.name, a.structure.name, b.men_at_arms, b.knights, b.leader.name, b.structure.name, wa, wb, ti])
+                    for a, b, wa, ti, wb in evaluate_b_combinations(Army(maa, kn, DefensiveStructure.NONE, ArmyLeader(lord)), memo):
+                        writer.writerow(odds_row(a, b, wa, ti, wb))
                             #if wb >= 0.95:
                                 #break
-                
+    if memo is not None:
+        memo.save()
+
+def matchups(attacker_min = 0, attacker_max = None, structures = None, leaders = None):
+    # the matchups of write_combinations, without its early stop on lopsided odds
+    structures = structures if structures is not None else list(DefensiveStructure)
+    leaders = leaders if leaders is not None else [ArmyLeader.LORD_OR_TITLED_LADY, ArmyLeader.NONE_OR_LADY]
+    for a_lord in leaders:
+        for a_kn in range(8, -1, -1):
+            for a_maa in range(13, -1, -1):
+                a = Army(a_maa, a_kn, DefensiveStructure.NONE, a_lord)
+                if a.strength_points() < attacker_min or (attacker_max is not None and a.strength_points() > attacker_max):
+                    continue
+                for b_lord in leaders:
+                    for b_defensive in structures:
+                        for b_kn in range(8, -1, -1):
+                            for b_maa in range(13, -1, -1):
+                                b = Army(b_maa, b_kn, b_defensive, b_lord)
+                                if a.strength_points() < b.strength_points():
+                                    continue # players will never consider attacking such an opponent
+                                yield a, b
+
+def matchup_odds(matchup):
+    a, b = matchup
+    return battle(a, b, memo=None)
+
+def odds_rows(matchups, workers = None, buffer = 64, memo = BATTLE_MEMO):
+    # streams (a, b, wa, ti, wb) in matchup order; at most `buffer` matchups
+    # are in flight, so memory stays constant and rows start right away
+    executor = ProcessPoolExecutor(workers) if workers is None or workers > 1 else None
+    pending = deque()
+
+    def finish(a, b, result):
+        if not isinstance(result, tuple):
+            result = result.result()
+            if memo is not None:
+                memo.put(a, b, BattleStopRule.ANNIHILATION, 1000, result)
+        wa, ti, wb, retreats = result
+        return a, b, wa, ti, wb
+
+    try:
+        for a, b in matchups:
+            result = memo.get(a, b, BattleStopRule.ANNIHILATION, 1000) if memo is not None else None
+            if result is None:
+                result = executor.submit(matchup_odds, (a, b)) if executor is not None else matchup_odds((a, b))
+                if executor is None and memo is not None:
+                    memo.put(a, b, BattleStopRule.ANNIHILATION, 1000, result)
+            pending.append((a, b, result))
+            while pending and (len(pending) > buffer or isinstance(pending[0][2], tuple) or pending[0][2].done()):
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+def write_rows(rows, f, format = "csv"):
+    if format not in ("csv", "ndjson"):
+        raise Exception("Unknown format")
+    if format == "csv":
+        writer = csv.writer(f)
+        writer.writerow(ODDS_HEADERS)
+        f.flush()
+    for a, b, wa, ti, wb in rows:
+        row = odds_row(a, b, wa, ti, wb)
+        if format == "csv":
+            writer.writerow(row)
+        else:
+            f.write(json.dumps(dict(zip(ODDS_HEADERS, row))) + "\n")
+        f.flush()
+
 #write_combinations()
 
 